@@ -1,34 +1,195 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
+import threading
+import msgspec
+import orjson
 import os
 
+from cache import SingleFlight, TTLCache, cache_key
+
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 API_KEY = os.getenv("OPENROUTER_API_KEY") 
 
-@app.route('/rewrite', methods=['POST'])
-def rewrite():
-    data = request.get_json()
-    caption = data.get("caption", "")
+# "openrouter" proxies to the hosted LLM; "bart" runs facebook/bart-large-cnn (see bart.py).
+MODE = os.getenv("MODE", "openrouter").lower()
+if MODE == "bart":
+    import bart
 
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
+class RewriteRequest(msgspec.Struct):
+    caption: str
+    stream: bool = False
+
+REQUEST_DECODER = msgspec.json.Decoder(RewriteRequest)
+
+MAX_CAPTION_CHARS = int(os.getenv("MAX_CAPTION_CHARS", "4096"))
+# Werkzeug refuses bodies over this before reading them. One caption character can take up
+# to 12 bytes of JSON (an escaped surrogate pair), plus room for the keys and whitespace.
+app.config["MAX_CONTENT_LENGTH"] = MAX_CAPTION_CHARS * 12 + 1024
+
+# Served by gunicorn's gevent worker (see gunicorn.conf.py), so each upstream call only
+# parks a greenlet; this caps how many are in flight at once so bursts queue up
+# instead of tripping OpenRouter's rate limit.
+MAX_INFLIGHT = int(os.getenv("OPENROUTER_MAX_INFLIGHT", "50"))
+QUEUE_TIMEOUT = float(os.getenv("OPENROUTER_QUEUE_TIMEOUT", "10"))
+INFLIGHT_SEM = threading.BoundedSemaphore(MAX_INFLIGHT)
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# One pooled session so the TLS connection to OpenRouter is kept alive across requests.
+SESSION = requests.Session()
+SESSION.headers.update({
+    "Authorization": f"Bearer {API_KEY}",
+    "Content-Type": "application/json"
+})
+# Completions are billed and not idempotent, so only failures to connect are retried;
+# urllib3's default allowed_methods never re-sends a POST after a response or read error.
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=MAX_INFLIGHT,
+    max_retries=Retry(total=3, backoff_factor=0.3)
+))
+
+# Point OPENROUTER_MODEL at a provider with prompt caching to get the system prefix discounted.
+MODEL = os.getenv("OPENROUTER_MODEL", "mistralai/mistral-7b-instruct")
+# Sent byte-for-byte identical as the first message of every request so provider-side
+# prefix caches keep hitting; don't interpolate anything into it.
+SYSTEM_PROMPT = "You rewrite social media captions to make them more engaging, clean, human, and short. Preserve hashtags."
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+CACHE = TTLCache()
+INFLIGHT = SingleFlight()
+
+class UpstreamBusy(Exception):
+    pass
+
+def sse(event):
+    return f"data: {orjson.dumps(event).decode()}\n\n"
+
+def stream_openrouter(key, payload):
+    # Taken before the response starts so overload is a 503 here too; released when the
+    # server closes the response, which WSGI guarantees even if the body is never read.
+    if not INFLIGHT_SEM.acquire(timeout=QUEUE_TIMEOUT):
+        return jsonify({"error": "Too many rewrites in flight, try again shortly"}), 503
+
+    def generate():
+        try:
+            parts = []
+            with SESSION.post(OPENROUTER_URL, json=dict(payload, stream=True), stream=True, timeout=30) as res:
+                res.raise_for_status()
+                for line in res.iter_lines():
+                    # OpenRouter interleaves ": OPENROUTER PROCESSING" comment lines with the data frames.
+                    if not line.startswith(b"data: "):
+                        continue
+                    data = line[len(b"data: "):]
+                    if data == b"[DONE]":
+                        break
+                    frame = orjson.loads(data)
+                    choice = frame["choices"][0] if frame.get("choices") else {}
+                    # Mid-stream failures arrive as a frame with "error" set and
+                    # finish_reason "error"; the partial text must not be cached.
+                    if "error" in frame or choice.get("finish_reason") == "error":
+                        error = frame.get("error") or {}
+                        message = error.get("message") if isinstance(error, dict) else str(error)
+                        yield sse({"error": message or "Upstream error during streaming"})
+                        return
+                    delta = choice.get("delta", {}).get("content")
+                    if delta:
+                        parts.append(delta)
+                        yield sse({"delta": delta})
+            if parts:
+                CACHE.set(key, "".join(parts))
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            yield sse({"error": str(e)})
+
+    response = Response(generate(), mimetype="text/event-stream", headers={"X-Cache": "MISS"})
+    response.call_on_close(INFLIGHT_SEM.release)
+    return response
+
+def call_openrouter(payload):
+    if not INFLIGHT_SEM.acquire(timeout=QUEUE_TIMEOUT):
+        raise UpstreamBusy("Too many rewrites in flight, try again shortly")
+    try:
+        res = SESSION.post(OPENROUTER_URL, json=payload, timeout=30)
+        res.raise_for_status()
+        return orjson.loads(res.content)["choices"][0]["message"]["content"]
+    finally:
+        INFLIGHT_SEM.release()
+
+def rewrite_openrouter(caption, stream=False):
+    key = cache_key(MODEL, SYSTEM_PROMPT, caption)
+    cached = CACHE.get(key)
+    if cached is not None:
+        if stream:
+            return Response([sse({"delta": cached}), "data: [DONE]\n\n"], mimetype="text/event-stream", headers={"X-Cache": "HIT"})
+        return jsonify({"rewritten": cached}), 200, {"X-Cache": "HIT"}
 
     payload = {
-        "model": "mistralai/mistral-7b-instruct",
+        "model": MODEL,
         "messages": [
-            {"role": "system", "content": "You rewrite social media captions to make them more engaging, clean, human, and short. Preserve hashtags."},
+            SYSTEM_MESSAGE,
             {"role": "user", "content": caption}
         ]
     }
+    if stream:
+        return stream_openrouter(key, payload)
 
     try:
-        res = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload, timeout=30)
-        output = res.json()["choices"][0]["message"]["content"]
-        return jsonify({"rewritten": output})
+        output = INFLIGHT.do(key, call_openrouter, payload)
+    except UpstreamBusy as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    CACHE.set(key, output)
+    return jsonify({"rewritten": output}), 200, {"X-Cache": "MISS"}
+
+def rewrite_bart(caption):
+    key = cache_key(bart.MODEL, caption)
+    cached = CACHE.get(key)
+    if cached is not None:
+        return jsonify({"rewritten": cached}), 200, {"X-Cache": "HIT"}
+
+    if bart.fits_output(caption):
+        return jsonify({"rewritten": caption, "skipped": True})
+
+    try:
+        output = INFLIGHT.do(key, bart.summarize, caption)
+    except bart.Overloaded as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    CACHE.set(key, output)
+    return jsonify({"rewritten": output}), 200, {"X-Cache": "MISS"}
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({"error": f"Caption is longer than {MAX_CAPTION_CHARS} characters"}), 413
+
+@app.route('/rewrite', methods=['POST'])
+def rewrite():
+    try:
+        req = REQUEST_DECODER.decode(request.get_data())
+    except msgspec.DecodeError as e:
+        return jsonify({"error": f"Invalid request: {e}"}), 400
+    caption = req.caption
+    if not caption.strip():
+        return jsonify({"error": "Caption is empty"}), 400
+    if len(caption) > MAX_CAPTION_CHARS:
+        return jsonify({"error": f"Caption is longer than {MAX_CAPTION_CHARS} characters"}), 413
+    if MODE == "bart":
+        return rewrite_bart(caption)
+    return rewrite_openrouter(caption, stream=req.stream)
 
 @app.route('/', methods=['GET'])
 def home():
@@ -0,0 +1,214 @@
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, BitsAndBytesConfig
+from concurrent.futures import Future
+from collections import namedtuple
+from requests.adapters import HTTPAdapter
+import functools
+import requests
+import threading
+import torch
+import queue
+import time
+import os
+
+MODEL = "facebook/bart-large-cnn"
+# Greedy decoding: bart-large-cnn defaults to 4 beams, which is 4x the decoder work for no
+# visible gain on 10-30 token captions. early_stopping/length_penalty are beam-only, so
+# they're reset from the checkpoint's beam defaults to keep generate() from warning.
+GEN_KWARGS = {
+    "max_length": 30,
+    "min_length": 10,
+    "do_sample": False,
+    "num_beams": 1,
+    "early_stopping": False,
+    "length_penalty": 1.0,
+    "no_repeat_ngram_size": 3
+}
+# Real captions are well under this; anything longer is cut before the encoder so one huge
+# input can't force a full 1024-token prefill.
+MAX_INPUT_TOKENS = int(os.getenv("REWRITER_MAX_INPUT_TOKENS", "256"))
+
+# Captions arriving within MAX_WAIT of each other share one forward pass.
+BATCH_SIZE = int(os.getenv("REWRITER_BATCH_SIZE", "8"))
+MAX_WAIT = float(os.getenv("REWRITER_MAX_WAIT_MS", "10")) / 1000
+
+# Assisted generation: a distilled draft (e.g. sshleifer/distilbart-cnn-6-6) proposes a few
+# tokens per step and BART verifies them in one pass. It only decodes one sequence at a
+# time, so batching is turned off when a draft is configured.
+DRAFT_MODEL = os.getenv("REWRITER_DRAFT_MODEL", "")
+if DRAFT_MODEL:
+    BATCH_SIZE = 1
+
+# Requests admitted to the model at once (queued + generating); the rest get a 503 after
+# ADMIT_TIMEOUT instead of piling up until the device runs out of memory. Size it to the
+# largest load that stays under ~80% of device memory.
+MAX_CONCURRENCY = int(os.getenv("REWRITER_MAX_CONCURRENCY", str(BATCH_SIZE * 4)))
+ADMIT_TIMEOUT = float(os.getenv("REWRITER_ADMIT_TIMEOUT", "0.1"))
+INFER_SEM = threading.BoundedSemaphore(MAX_CONCURRENCY)
+
+# Lets any remaining fp32 matmuls (e.g. the quantized path's activations) use tensor cores.
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+# Optional weight quantization: "int8"/"int4" via bitsandbytes on GPU (needs the
+# bitsandbytes and accelerate packages), "int8" dynamic quantization of the Linear layers
+# on CPU. Anything else fails here rather than silently loading full-precision weights.
+QUANTIZE = os.getenv("REWRITER_QUANTIZE", "").lower()
+if QUANTIZE not in ("", "int8", "int4"):
+    raise ValueError(f"REWRITER_QUANTIZE must be empty, 'int8' or 'int4', got {QUANTIZE!r}")
+if QUANTIZE == "int4" and not torch.cuda.is_available():
+    raise ValueError("REWRITER_QUANTIZE=int4 needs a CUDA device; use 'int8' on CPU")
+
+# When set, generation is delegated to an OpenAI-compatible server (vLLM/TGI) that does
+# continuous batching itself, and no model is loaded in this process.
+BACKEND_URL = os.getenv("REWRITER_BACKEND_URL", "").rstrip("/")
+# Sized to the admission limit so every concurrent sidecar call keeps its connection alive
+# instead of overflowing urllib3's default pool of 10.
+BACKEND_SESSION = requests.Session()
+BACKEND_SESSION.mount("http://", HTTPAdapter(pool_maxsize=MAX_CONCURRENCY))
+BACKEND_SESSION.mount("https://", HTTPAdapter(pool_maxsize=MAX_CONCURRENCY))
+
+# Compiles the forward pass (fused kernels, CUDA graphs) at the cost of a slower first load.
+# GPU only: reduce-overhead's CUDA graphs do nothing on CPU, and the CPU model is loaded in
+# the gunicorn master, where compile workers and thread pools must not be started pre-fork.
+COMPILE = os.getenv("REWRITER_COMPILE", "") == "1"
+
+# Generation is memory-bandwidth bound, so half-precision weights on GPU nearly double
+# throughput; bf16 where the card supports it for fp32-like range. Resolved on first use:
+# is_bf16_supported() starts CUDA, which must not happen in a gunicorn master that forks.
+@functools.lru_cache(maxsize=1)
+def get_device():
+    if not torch.cuda.is_available():
+        return -1, torch.float32
+    return 0, torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+@functools.lru_cache(maxsize=1)
+def get_tokenizer():
+    return AutoTokenizer.from_pretrained(MODEL)
+
+def fits_output(caption):
+    # A caption already within the output budget would come back essentially verbatim.
+    return len(get_tokenizer()(caption, add_special_tokens=False).input_ids) <= GEN_KWARGS["max_length"]
+
+Rewriter = namedtuple("Rewriter", ["model", "tokenizer"])
+
+# Loaded on first use rather than at import, so processes that never serve a BART
+# request (or the OpenRouter mode) don't pay for it. The batcher tokenizes and calls
+# generate() itself, so the model and tokenizer are loaded directly rather than through a
+# summarization pipeline. The tokenizer is its own instance, separate from get_tokenizer()'s,
+# so request threads and the batcher never share one with different truncation settings.
+@functools.lru_cache(maxsize=1)
+def get_rewriter():
+    device, dtype = get_device()
+    tokenizer = AutoTokenizer.from_pretrained(MODEL)
+    if QUANTIZE in ("int8", "int4") and device >= 0:
+        if QUANTIZE == "int8":
+            quant_config = BitsAndBytesConfig(load_in_8bit=True)
+        else:
+            quant_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=dtype)
+        model = AutoModelForSeq2SeqLM.from_pretrained(MODEL, quantization_config=quant_config, device_map="auto", dtype=dtype)
+        return Rewriter(model.eval(), tokenizer)
+
+    model = AutoModelForSeq2SeqLM.from_pretrained(MODEL, dtype=dtype).eval()
+    if device >= 0:
+        model = model.to(f"cuda:{device}")
+    rw = Rewriter(model, tokenizer)
+    if QUANTIZE == "int8":
+        rw = rw._replace(model=torch.ao.quantization.quantize_dynamic(rw.model, {torch.nn.Linear}, dtype=torch.qint8))
+    elif COMPILE and device >= 0:
+        # generate() calls self.forward, so compile that rather than wrapping the module.
+        rw.model.forward = torch.compile(rw.model.forward, mode="reduce-overhead", fullgraph=False)
+        # Trigger compilation/graph capture now instead of on the first real request.
+        inputs = rw.tokenizer(["Warming up the caption rewriter."], return_tensors="pt").to(rw.model.device)
+        with torch.inference_mode():
+            rw.model.generate(**inputs, **GEN_KWARGS)
+    return rw
+
+@functools.lru_cache(maxsize=1)
+def get_generate_kwargs():
+    kwargs = dict(GEN_KWARGS)
+    if DRAFT_MODEL:
+        draft = AutoModelForSeq2SeqLM.from_pretrained(DRAFT_MODEL, dtype=get_device()[1]).to(get_rewriter().model.device)
+        draft.generation_config.num_assistant_tokens = 5
+        kwargs["assistant_model"] = draft
+        # Assisted generation only supports greedy/sampling; bart-large-cnn's own config
+        # asks for 4 beams, so pin greedy here rather than rely on GEN_KWARGS.
+        kwargs["num_beams"] = 1
+        kwargs["do_sample"] = False
+    return kwargs
+
+class Overloaded(Exception):
+    pass
+
+_pending = queue.Queue()
+_batcher = None
+_batcher_lock = threading.Lock()
+
+def _batch_loop():
+    while True:
+        batch = [_pending.get()]
+        deadline = time.monotonic() + MAX_WAIT
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        captions = [caption for caption, _ in batch]
+        try:
+            rewriter = get_rewriter()
+            tokenizer = rewriter.tokenizer
+            inputs = tokenizer(captions, truncation=True, max_length=MAX_INPUT_TOKENS, padding=True, return_tensors="pt")
+            if rewriter.model.device.type == "cuda":
+                # Pinned host memory lets the copy to the GPU run asynchronously.
+                inputs = {name: t.pin_memory().to(rewriter.model.device, non_blocking=True) for name, t in inputs.items()}
+            else:
+                inputs = inputs.to(rewriter.model.device)
+            with torch.inference_mode():
+                output_ids = rewriter.model.generate(**inputs, **get_generate_kwargs())
+            results = tokenizer.batch_decode(output_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        except Exception as e:
+            for _, fut in batch:
+                fut.set_exception(e)
+            continue
+        for (_, fut), result in zip(batch, results):
+            fut.set_result(result)
+
+def summarize_remote(caption):
+    # Same input budget as the local batcher. Slicing the ids (rather than truncation=True)
+    # keeps this call's tokenizer settings identical to fits_output(), which shares it.
+    ids = get_tokenizer()(caption, add_special_tokens=False).input_ids
+    if len(ids) > MAX_INPUT_TOKENS:
+        caption = get_tokenizer().decode(ids[:MAX_INPUT_TOKENS])
+    payload = {
+        "model": MODEL,
+        "prompt": caption,
+        "max_tokens": GEN_KWARGS["max_length"],
+        "temperature": 0
+    }
+    res = BACKEND_SESSION.post(f"{BACKEND_URL}/v1/completions", json=payload, timeout=30)
+    res.raise_for_status()
+    return res.json()["choices"][0]["text"].strip()
+
+def _summarize_local(caption):
+    global _batcher
+    # Started on first use so it lives in the serving process, not a pre-fork parent.
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = threading.Thread(target=_batch_loop, name="rewriter-batcher", daemon=True)
+            _batcher.start()
+    fut = Future()
+    _pending.put((caption, fut))
+    return fut.result()
+
+def summarize(caption):
+    if not INFER_SEM.acquire(timeout=ADMIT_TIMEOUT):
+        raise Overloaded("Rewriter is at capacity, try again shortly")
+    try:
+        if BACKEND_URL:
+            return summarize_remote(caption)
+        return _summarize_local(caption)
+    finally:
+        INFER_SEM.release()
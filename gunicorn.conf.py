@@ -0,0 +1,35 @@
+import os
+
+# Makes torch.cuda.is_available() query NVML instead of initialising CUDA, so the master
+# can check for a GPU without breaking CUDA in the workers it forks.
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+
+MODE = os.getenv("MODE", "openrouter").lower()
+
+if MODE == "bart":
+    # One process owns the model (and GPU context); its threads share it and feed the
+    # micro-batcher, and torch releases the GIL while generating.
+    worker_class = "gthread"
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    threads = int(os.getenv("GUNICORN_THREADS", "32"))
+    # Import the app (and torch) once in the master so workers share its pages copy-on-write.
+    preload_app = True
+else:
+    # Pure network I/O: a greenlet per request, so one worker already holds thousands of
+    # connections. Keep it to one process so OPENROUTER_MAX_INFLIGHT, the rewrite cache and
+    # single-flight map stay service-wide rather than per worker.
+    # gevent has to patch the stdlib inside each worker before the app is imported,
+    # so the OpenRouter mode is never preloaded.
+    worker_class = "gevent"
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "2000"))
+
+def when_ready(server):
+    if MODE != "bart":
+        return
+    import bart
+    import torch
+    # CUDA contexts don't survive fork, so only CPU weights are loaded ahead of the workers;
+    # on GPU hosts each worker resolves the device and loads the model on first request.
+    if not torch.cuda.is_available() and not bart.BACKEND_URL:
+        bart.get_rewriter()